@@ -21,15 +21,32 @@
 
 import argparse
 import os
+import queue
 import re
+import selectors
 import sys
+import threading
 import time
 
-from collections import deque
-from datetime import datetime, timedelta
+from datetime import datetime
 
 import serial
 
+try:
+    from re import _parser as sre_parse  # Python 3.11 and later.
+except ImportError:
+    import sre_parse
+
+try:
+    import hyperscan  # Optional; much faster matching where it's available (not on Windows).
+except ImportError:
+    hyperscan = None
+
+try:
+    import pcre2  # Optional; JIT-compiled regexes, for --engine pcre2.
+except ImportError:
+    pcre2 = None
+
 
 # Different ways we can trigger an event:
 EVENT_MATCH = 'match'  # Simply if a regex is found in a line.
@@ -37,20 +54,28 @@ EVENT_DELTA = 'delta'  # If a regex is found, AND the line differs from the prev
 EVENT_RUN = 'run'    # If a regex is found, AND there has not been a match in the previous args.windowRadius lines.
 EVENT_NOPULSE = 'nopulse'   # If the regex hasn't been seen for args.windowTime seconds.
 
+# The most pieces that one os.writev() call can gather, or 0 if there isn't one (on Windows).
+try:
+    IOV_MAX = max(os.sysconf('SC_IOV_MAX'), 16) if hasattr(os, 'writev') else 0
+except (ValueError, OSError):
+    IOV_MAX = 16
+
+READ_TIMEOUT = 0.1  # Seconds a port can be quiet before what's arrived of a line is processed without its newline.
+MAX_LINE_LENGTH = 4096  # Bytes of a line without a newline that are kept before processing them anyway.
+
 
 serialPortNames = []
 serialPorts = []
+portBuffers = []  # Bytes read from each port that aren't yet a complete line, as bytearrays.
+portDataTimes = []  # When each port last had data, by time.monotonic().
 numEvents = 0
-previousMatchLine = ''
+previousMatchLine = b''
+lastStatsTime = 0.0  # When stats were last printed for an event, from time.monotonic().
 
 
-def _now():
-    ''' Return the current time, in the configured timezone. '''
-    global args
-    if args.utc:
-        return datetime.utcnow()
-    else:
-        return datetime.now()
+def _formatTime(t):
+    ''' Return the bytes used to timestamp lines in the log file. '''
+    return t.isoformat(' ', 'microseconds').encode('ascii')
 
 def printStats():
     global numEvents
@@ -58,89 +83,363 @@ def printStats():
     total_time = _now() - start_time
     if numEvents:
         print("\n\nThere have been {} event(s) in {}, for an average time between of {}.\n".format(
-            numEvents, total_time, total_time / (numEvents + 1)))
+            numEvents, total_time, total_time / (numEvents + 1)), flush=True)
     else:
-        print("\n\nThere have been no events in {}.".format(total_time))
-
-def headerForPort(i):
-    # Return the string to print at the start of each line to indicate what port it's from.
-    if len(serialPorts) == 1:
-        return ""
-    elif len(serialPorts) <= 3:
-        return ["< ", " >", "  "][i]
+        print("\n\nThere have been no events in {}.".format(total_time), flush=True)
+
+def headersForPorts(n):
+    # Return the bytes to print at the start of each line to indicate what port it's from,
+    # as a tuple indexed by port number, for n ports.
+    if n == 1 or n > 3:
+        return (b"",) * n
     else:
-        return ""
+        return (b"< ", b" >", b"  ")[:n]
 
-log = deque([])
+class RingBuffer:
+    ''' A first-in, first-out queue kept in a preallocated list that's reused in a circle,
+        so that steady-state logging doesn't allocate anything.
+        It doubles in size if it has to hold more than its capacity, as when waiting for a pulse.
+    '''
+    __slots__ = ('items', 'mask', 'head', 'count')
+
+    def __init__(self, capacity):
+        size = 1
+        while size < capacity:
+            size <<= 1
+        self.items = [None] * size
+        self.mask = size - 1  # The size is a power of two, so indices wrap around with a mask.
+        self.head = 0  # Index of the oldest item.
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, item):
+        if self.count > self.mask:
+            self.items = self.items[self.head:] + self.items[:self.head] + [None] * len(self.items)
+            self.mask = len(self.items) - 1
+            self.head = 0
+        self.items[(self.head + self.count) & self.mask] = item
+        self.count += 1
+
+    def popleft(self):
+        item = self.items[self.head]
+        self.head = (self.head + 1) & self.mask
+        self.count -= 1
+        return item
+
+    def keepNewest(self, n):
+        ''' Discard the oldest items, so that no more than n are left. '''
+        if self.count > n:
+            self.head = (self.head + self.count - n) & self.mask
+            self.count = n
+
+log = None  # The RingBuffer of recent lines, already encoded for the log file; created once we know the window size.
+pendingLogOutput = []  # Encoded lines that are ready to be written to the log file, all at once.
 waitingForLogLines = 0;
-def logLine(line, timestamp=True):
+def logLine(line: bytes, timestamp=None):
     ''' Add this line to a managed log, that will be dumped to a file only around events.
-      If timestamp is False, omit the usual prefix of the date and time.
+      timestamp is the already-formatted date and time to prefix it with; if it's empty, there's no prefix,
+      and if it's None, it's the current time.
     '''
-    global args, log, waitingForLogLines, saw_pulse
-    log.append([_now() if timestamp else "", line, saw_pulse])
-    print(numEvents, line)
-    maybeOutput();
+    global log, pendingLogOutput, waitingForLogLines, saw_pulse
+    if timestamp is None:
+        timestamp = _formatTime(_now())
+    log.append(timestamp + b' ' + line + b'\n' if timestamp else line + b'\n')
+    sys.stdout.buffer.write(b'%d %s\n' % (numEvents, line))
+
+    # Send output to the log file if we are still logging after an event.
+    # This is maybeOutput() inlined, since it runs for every line.
+    if waitingForLogLines:
+        n = min(waitingForLogLines, len(log))
+        waitingForLogLines -= n
+        for _ in range(n):
+            pendingLogOutput.append(log.popleft())
 
     # Remove lines we no longer need from the log.
     # If this line is a pulse, remove all the previous lines.
     # Keep the windowRadius at a minimum.
-    while len(log) > args.windowRadius and (args.mode != EVENT_NOPULSE or saw_pulse):
-        log.popleft()
+    if MODE != EVENT_NOPULSE or saw_pulse:
+        log.keepNewest(WINDOW_RADIUS)
 
-def isOlderThanWindow(t, pad=0):
-    ''' Return True if time t is longer ago than the window seconds argument.
+def isOlderThanWindow(t, now, pad=0):
+    ''' Return True if time t is longer before now than the window seconds argument.
+        Both are in seconds from time.monotonic().
         If pad is specified, extend the window by that many seconds.
     '''
-    return t < (_now() - timedelta(seconds=args.windowSecs + pad))
+    return now - t > WINDOW_SECS + pad
 
 def maybeOutput():
-    ''' Write pending lines to the log file, and remove them from the log. '''
-    global waitingForLogLines, log
+    ''' Queue pending lines to be written to the log file, and remove them from the log. '''
+    global waitingForLogLines, log, pendingLogOutput
     # Send output to the log file if we are still logging after an event.
-    while waitingForLogLines and len(log):
-        waitingForLogLines -= 1
-        writeToFile(log.popleft())
-
-def writeToFile(logEntry):
-    global args, logFile
-    line = str(logEntry[0])
-    if line:
-      line += ' ' + logEntry[1]
-    else:
-      line = logEntry[1]
-    print(line, file=logFile)
-
-def isEvent(line: str):
-    ''' Return true iff line triggers an event.
-        If we're looking for no-pulse and it *is* a pulse, set the global saw_pulse.
+    # Work on locals in the loop, since it runs for the whole window at once.
+    n = min(waitingForLogLines, len(log))
+    if n:
+        waitingForLogLines -= n
+        popleft = log.popleft
+        for _ in range(n):
+            pendingLogOutput.append(popleft())
+
+def writeToFile(line: str, timestamp=b''):
+    ''' Queue a line to be written to the log file, prefixed by timestamp if it's given. '''
+    global pendingLogOutput
+    entry = line.encode('utf-8') + b'\n'
+    if timestamp:
+      entry = timestamp + b' ' + entry
+    pendingLogOutput.append(entry)
+
+def flushLog():
+    ''' Write all the queued output to the log file, with one system call.
+        The pieces are gathered by os.writev() where it's available, without joining them first.
     '''
-    global args, regexes, previousMatchLine, last_match_time, saw_pulse
-
-    # See if we have a match.
-    if any([regex.search(line) for regex in regexes]):
-        if args.mode == EVENT_MATCH or args.mode == EVENT_RUN:
-            return True
-        elif args.mode == EVENT_DELTA:
-            if line != previousMatchLine:
-                previousMatchLine = line
-                return True
-        elif args.mode == EVENT_NOPULSE:
-            last_match_time = _now()
-            saw_pulse = True
-    elif args.mode == EVENT_NOPULSE and isOlderThanWindow(last_match_time):
+    global pendingLogOutput, logFd
+    if pendingLogOutput:
+        pieces = pendingLogOutput
+        pendingLogOutput = []
+        if len(pieces) <= IOV_MAX:
+            written = os.writev(logFd, pieces)
+            if written == sum(map(len, pieces)):
+                return
+            data = b''.join(pieces)[written:]
+        else:
+            data = b''.join(pieces)
+        while data:
+            data = data[os.write(logFd, data):]
+
+# isEvent(line) returns true iff line triggers an event.
+# It's one of these functions, or just eventSearch, picked at startup for the event mode.
+
+def isDeltaEvent(line: bytes):
+    ''' For EVENT_DELTA: return true iff line matches, and isn't the same as the previous match. '''
+    global eventSearch, previousMatchLine
+
+    if eventSearch(line) and line != previousMatchLine:
+        previousMatchLine = line
         return True
     return False
 
+def isNoPulseEvent(line: bytes):
+    ''' For EVENT_NOPULSE: return true iff there hasn't been a match for too long.
+        If line *is* a pulse, set the global saw_pulse.
+    '''
+    global eventSearch, last_match_time, saw_pulse
+
+    if eventSearch(line):
+        last_match_time = time.monotonic()
+        saw_pulse = True
+        return False
+    return isOlderThanWindow(last_match_time, time.monotonic())
+
+def _literalOf(pattern):
+    ''' Return the string that pattern matches, if it's just a sequence of literal characters; otherwise None. '''
+    try:
+        parsed = sre_parse.parse(pattern)
+    except re.error:
+        return None
+    if parsed.state.flags & ~re.UNICODE:
+        return None  # It sets inline flags, like (?i).
+    if any(op != sre_parse.LITERAL for op, _ in parsed):
+        return None
+    return ''.join(chr(c) for _, c in parsed)
+
+def _triggerCharsOf(items, ignorecase):
+    ''' Return a set of characters, at least one of which must be in any match of the parsed regex items;
+        or None if there isn't one we can be sure of.
+        With ignorecase, only characters that have no case (ASCII punctuation and the like) are used.
+    '''
+    best = None
+    for op, av in items:
+        chars = None
+        if op == sre_parse.LITERAL:
+            c = chr(av)
+            if not ignorecase or (c.isascii() and not c.isalpha()):
+                chars = {c}
+        elif op == sre_parse.IN:
+            # A set like [!?] needs one of its characters, if they're all plain ones.
+            if all(o == sre_parse.LITERAL for o, _ in av):
+                chars = {chr(a) for _, a in av}
+                if ignorecase and not all(c.isascii() and not c.isalpha() for c in chars):
+                    chars = None
+        elif op == sre_parse.SUBPATTERN:
+            if not av[1] and not av[2]:  # It doesn't change the flags.
+                chars = _triggerCharsOf(av[3], ignorecase)
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            if av[0] >= 1:
+                chars = _triggerCharsOf(av[2], ignorecase)
+        elif op == sre_parse.BRANCH:
+            # Each alternative needs one of its own characters.
+            chars = set()
+            for branch in av[1]:
+                more = _triggerCharsOf(branch, ignorecase)
+                if not more:
+                    chars = None
+                    break
+                chars |= more
+
+        # Prefer characters that don't look like ordinary text, and then fewer of them.
+        if chars and (best is None or _triggerRank(chars) < _triggerRank(best)):
+            best = chars
+    return best
+
+def _triggerRank(chars):
+    ''' Return a sort key for sets of trigger characters: lower is likely to be rarer in a line. '''
+    return (sum(c.isspace() for c in chars), sum(c.isalnum() for c in chars), len(chars))
+
+def _triggerCharsOfAll(patterns, ignorecase):
+    ''' Return a set of characters that any line matching any of the patterns must contain one of, or None. '''
+    triggers = set()
+    for p in patterns:
+        try:
+            parsed = sre_parse.parse(p)
+        except re.error:
+            return None
+        more = _triggerCharsOf(parsed, ignorecase or parsed.state.flags & re.IGNORECASE)
+        if not more:
+            return None
+        triggers |= more
+    return triggers
+
+# Backreferences, conditionals and recursion refer to groups by number or name, so they'd change meaning
+# if their pattern were combined with others.
+_GROUP_REFERENCE = re.compile(r'\\[1-9gk]|\(\?P[=>]|\(\?\(|\(\?[R&+\-0-9]')
+
+def _canCombine(pattern):
+    ''' Return whether pattern means the same thing as one alternative among others. '''
+    if _GROUP_REFERENCE.search(pattern):
+        return False
+    try:
+        parsed = sre_parse.parse(pattern)
+    except re.error:
+        return False  # Perhaps it's meant for another engine; it can still be searched for by itself.
+    # Inline flags like (?i) at the start apply to the whole regex, so they'd leak into the other patterns
+    # (before Python 3.11, they're allowed anywhere, with just a DeprecationWarning).
+    return not parsed.state.flags & ~re.UNICODE
+
+def _combinedSearch(patterns, compile, errors):
+    ''' Return a function that takes a line, and returns something true iff any of the patterns is found in it.
+        compile() turns a pattern into a regex object, raising one of errors if it can't.
+        Each pattern is compiled by itself first, so that a bad one is reported, rather than one that only
+        makes sense as part of the alternation (like 'x)|(y').
+        Then they're combined into one alternation, so each line is only scanned once;
+        unless that would change what they mean, or wouldn't compile (as with the same group name in two patterns),
+        in which case each one is searched for in turn.
+    '''
+    regexes = [compile(p) for p in patterns]
+    if len(regexes) == 1:
+        return regexes[0].search
+    if all(_canCombine(p) for p in patterns):
+        try:
+            return compile('|'.join('(?:' + p + ')' for p in patterns)).search
+        except errors:
+            pass
+    def eachSearch(line):
+        return any(r.search(line) for r in regexes)
+    return eachSearch
+
+def _onHyperscanMatch(id, start, end, flags, found):
+    ''' Hyperscan match callback: note that the line matched, and stop scanning, since one match is enough. '''
+    found.append(id)
+    return True
+
+def makeEventSearch(patterns, ignorecase, engine='auto'):
+    ''' Return a function that takes a line as bytes, and returns something true iff any of the patterns is found in it.
+        engine is the --engine argument, for which regex library to use.
+        ASCII patterns are matched against the bytes directly (so \\xff means that byte, and case is ASCII);
+        lines are only decoded for patterns that need it.
+    '''
+    try:
+        for p in patterns:
+            re.compile(p.encode('ascii'))
+    except (UnicodeEncodeError, re.error):
+        textSearch = _makeSearch(patterns, ignorecase, engine, False)
+        def decodingSearch(line):
+            return textSearch(line.decode('utf-8', errors='replace'))
+        return decodingSearch
+    return _makeSearch(patterns, ignorecase, engine, True)
+
+def _makeSearch(patterns, ignorecase, engine, asBytes):
+    ''' Return a function that takes a line, as bytes if asBytes or else str, and returns something true
+        iff any of the patterns is found in it.
+        If the patterns are all plain strings, they're just searched for as substrings
+        (in the lowercased line, if ignorecase).
+        Otherwise, uses the regex engine: for 'auto', Hyperscan if it's installed and can compile all the patterns,
+        or else re. With re, it first checks that the line has at least one character that every match would need,
+        if there are any.
+    '''
+    # Patterns are analyzed as text, then converted to the type the lines will be.
+    convert = (lambda s: s.encode('latin-1')) if asBytes else (lambda s: s)
+
+    literals = [_literalOf(p) for p in patterns]
+    if None not in literals:
+        literals = [convert(literal) for literal in literals]
+    if None not in literals and ignorecase:
+        literals = [literal.lower() for literal in literals]
+        def caselessLiteralSearch(line):
+            line = line.lower()
+            return any(literal in line for literal in literals)
+        return caselessLiteralSearch
+    elif None not in literals:
+        def literalSearch(line):
+            return any(literal in line for literal in literals)
+        return literalSearch
+
+    search = None
+    if engine == 'pcre2':
+        flags = pcre2.IGNORECASE if ignorecase else 0
+        # Any error from combining the patterns just means they're compiled one by one,
+        # where a real problem with one of them still raises.
+        search = _combinedSearch(patterns, lambda p: pcre2.compile(convert(p), flags=flags, jit=True), Exception)
+    elif engine in ('auto', 'hyperscan') and hyperscan:
+        flags = hyperscan.HS_FLAG_SINGLEMATCH
+        if not asBytes:
+            flags |= hyperscan.HS_FLAG_UTF8
+        if ignorecase:
+            flags |= hyperscan.HS_FLAG_CASELESS
+        db = hyperscan.Database()
+        try:
+            db.compile(expressions=[p.encode('utf-8') for p in patterns],
+                ids=list(range(len(patterns))), elements=len(patterns), flags=[flags] * len(patterns))
+        except hyperscan.error as e:
+            if engine == 'hyperscan':
+                sys.exit("Hyperscan can't compile the regexes ({}).".format(e))
+            print("Hyperscan can't compile the regexes ({}), so using re instead.".format(e))
+        else:
+            def hyperscanSearch(line):
+                found = []
+                try:
+                    db.scan(line if asBytes else line.encode('utf-8'), match_event_handler=_onHyperscanMatch, context=found)
+                except hyperscan.ScanTerminated:
+                    pass  # That's how stopping at the first match is reported.
+                return found
+            search = hyperscanSearch
+
+    if search:
+        return search
+
+    flags = re.IGNORECASE if ignorecase else 0
+    search = _combinedSearch(patterns, lambda p: re.compile(convert(p), flags), re.error)
+
+    # Most lines won't have any of the characters that a match needs, and 'in' rules those out quickly.
+    # This is only done for re, which parses the patterns the same way as sre_parse does;
+    # other engines can read some of them differently (e.g. [[:digit:]] is a POSIX class to them).
+    triggers = _triggerCharsOfAll(patterns, ignorecase)
+    if triggers:
+        triggers = tuple(convert(c) for c in triggers)
+        def prefilteredSearch(line):
+            return any(c in line for c in triggers) and search(line)
+        return prefilteredSearch
+    return search
+
 def logEvent():
-    global args, log, waitingForLogLines, numEvents
+    global log, waitingForLogLines, numEvents, lastStatsTime
 
-    isInRun = args.mode == EVENT_RUN and waitingForLogLines > 0
-    isInRun = isInRun or args.mode == EVENT_NOPULSE and len(log) == 0
+    isInRun = MODE == EVENT_RUN and waitingForLogLines > 0
+    isInRun = isInRun or MODE == EVENT_NOPULSE and len(log) == 0
 
     # Output an event separator if we're not currently showing an event.
     if not isInRun:
-      writeToFile(["", ""])
+      writeToFile("")
 
     # Output all the lines that we already have saved.
     waitingForLogLines = len(log)
@@ -149,38 +448,108 @@ def logEvent():
     # Output some stuff about the event.
     if not isInRun:
       numEvents += 1
-      logLine(f"==\n== EVENT FOUND (#{numEvents}) ==\n==", timestamp=False)
-    printStats()
+      logLine(b"==\n== EVENT FOUND (#%d) ==\n==" % numEvents, b'')
+
+    # Show the stats, but not more than once a second when events come thick and fast.
+    now = time.monotonic()
+    if now - lastStatsTime > 1.0:
+        printStats()
+        lastStatsTime = now
     
     # Note that we want to output another half-window of lines afterwards.
-    waitingForLogLines = args.windowRadius
+    waitingForLogLines = WINDOW_RADIUS
 
 def processPort(i):
-    # Read and echo a line from the given port.
+    # Read and process everything that's waiting on the given port.
+    # Ask for at least a byte, so that a port that's gone away raises an error instead of reading nothing forever.
+    thePort = serialPorts[i]
+    processData(i, thePort.read(thePort.in_waiting or 1))
+
+def processData(i, data):
+    ''' Add bytes read from port i to what's been read from it so far, and process each complete line.
+        The rest is kept for later, unless there's more of it than any line should be.
+    '''
+    buffer = portBuffers[i]
+    if buffer:
+        buffer += data
+        data = bytes(buffer)
+        buffer.clear()
+    start = 0
+    while (end := data.find(b'\n', start)) >= 0:
+        processLine(i, data[start:end])
+        start = end + 1
+    buffer += memoryview(data)[start:]
+    portDataTimes[i] = time.monotonic()
+    if len(buffer) > MAX_LINE_LENGTH:
+        processLeftover(i)
+
+def processLeftover(i):
+    ''' Process what's been read from port i since its last newline, if anything, as a line of its own. '''
+    buffer = portBuffers[i]
+    if buffer:
+        data = bytes(buffer)
+        buffer.clear()
+        processLine(i, data)
+
+def processQuietPorts():
+    ''' Process what's arrived of a line from each port that's had no more data for READ_TIMEOUT,
+        as readline() would have.  Some devices end lines with just \r, for instance.
+    '''
+    now = time.monotonic()
+    for i, buffer in enumerate(portBuffers):
+        if buffer and now - portDataTimes[i] >= READ_TIMEOUT:
+            processLeftover(i)
+
+def processLine(i, data):
+    # Echo a line read from port i, as bytes, without its newline.
     # Log events if they're found.
-    # Return the line read; '' means there was a timeout and nothing was read.
-    global numEvents, serialPorts, saw_pulse
+    # It stays as bytes throughout, so line noise is passed through as-is.
+    global numEvents, saw_pulse
 
-    # Read the next line.
-    thePort = serialPorts[i]
+    line = data.strip()
+    timestamp = _formatTime(_now())
 
-    try:
-        line = thePort.readline().decode('utf-8')
-    except UnicodeDecodeError:
-        line = ' [bad Unicode decoding, maybe line noise?]'
-
-    if line != '':
-        line = line.strip()
-
-        # Look for events.
-        saw_pulse = False
-        if (isEvent(line)):
-            logLine(headerForPort(i) + ' ' + line)
-            logEvent()
-        else:
-            logLine(headerForPort(i) + ('*' if saw_pulse else ' ') + line)
+    # Look for events.
+    saw_pulse = False
+    if (isEvent(line)):
+        logLine(portHeaders[i] + b' ' + line, timestamp)
+        logEvent()
+    else:
+        logLine(portHeaders[i] + (b'*' if saw_pulse else b' ') + line, timestamp)
 
-    return line
+def readPortToQueue(i):
+    ''' Thread body: read from port i forever, and queue up what arrives for the main thread to process.
+        If reading fails (as when the port goes away), queue the exception instead, for the main thread to raise.
+    '''
+    port = serialPorts[i]
+    try:
+        while True:
+            data = port.read(port.in_waiting or 1)
+            if data:
+                dataQueue.put((i, data))
+    except Exception as e:
+        dataQueue.put((i, e))
+
+def processReadyPorts():
+    ''' Wait up to a second for input on any of the ports, and process all the lines that have arrived.
+        Only wait up to READ_TIMEOUT if there's part of a line waiting to be processed, in case no more comes.
+    '''
+    waitingForMore = any(portBuffers)
+    if portSelector:
+        for key, _ in portSelector.select(timeout=READ_TIMEOUT if waitingForMore else 1.0):
+            processPort(key.data)
+    else:
+        try:
+            i, data = dataQueue.get(timeout=READ_TIMEOUT if waitingForMore else 0.5)
+            while True:
+                if isinstance(data, Exception):
+                    raise data
+                processData(i, data)
+                i, data = dataQueue.get_nowait()
+        except queue.Empty:
+            pass
+    if waitingForMore:
+        processQuietPorts()
 
 
 # Parse command-line arguments.
@@ -210,57 +579,99 @@ parser.add_argument('--nopulse', dest='mode', action='store_const', const=EVENT_
 parser.add_argument('--regex', nargs='+', required=True, action='extend',
                     help='A line that matches one or more regexes, anywhere, is an event.')
 
+parser.add_argument('--engine', choices=['auto', 're', 'hyperscan', 'pcre2'], default='auto',
+                    help='regex library to match with; auto uses hyperscan if it\'s installed, or else re')
 parser.add_argument('--ignorecase', action='store_true',
                     help='whether to distinguish upper and lower case letters or not')
 parser.add_argument('--utc', action='store_true',
                     help='whether to log times in UTC, vs. local time')
 
 args = parser.parse_args()
+if args.engine == 'hyperscan' and not hyperscan:
+    parser.error("--engine hyperscan needs the hyperscan package installed")
+if args.engine == 'pcre2' and not pcre2:
+    parser.error("--engine pcre2 needs the pcre2 package installed")
+
+# Settings that are used for every line, as plain globals.
+MODE = args.mode
+WINDOW_RADIUS = args.windowRadius
+WINDOW_SECS = args.windowSecs
+_now = datetime.utcnow if args.utc else datetime.now  # The current time, in the configured timezone.
 
 
 # Serial port setup
 for nextPort in args.serialPorts:
     print("Connecting to serial port '{}'.".format(nextPort))
     serialPortNames.append(nextPort)
-    serialPorts.append(serial.Serial(nextPort, args.baud, timeout=0.1))
+    serialPorts.append(serial.Serial(nextPort, args.baud, timeout=READ_TIMEOUT))
+    portBuffers.append(bytearray())
+    portDataTimes.append(time.monotonic())
+portHeaders = headersForPorts(len(serialPorts))
+
+# Sleep until any of the ports has input, instead of polling each one in turn.
+portSelector = selectors.DefaultSelector() if os.name != 'nt' else None
+if portSelector:
+    try:
+        for i, port in enumerate(serialPorts):
+            portSelector.register(port.fileno(), selectors.EVENT_READ, i)
+    except (OSError, ValueError):
+        portSelector.close()
+        portSelector = None
+if not portSelector:
+    # Serial ports can't be selected on Windows, so give each one a thread that queues up what it reads.
+    dataQueue = queue.Queue()
+    for i in range(len(serialPorts)):
+        threading.Thread(target=readPortToQueue, args=(i,), daemon=True).start()
 
 
 # Other set up and banner.
-regexes = [re.compile(r, re.IGNORECASE if args.ignorecase else 0) for r in args.regex]
+eventSearch = makeEventSearch(args.regex, args.ignorecase, args.engine)
+isEvent = {EVENT_MATCH: eventSearch, EVENT_RUN: eventSearch,
+    EVENT_DELTA: isDeltaEvent, EVENT_NOPULSE: isNoPulseEvent}[MODE]
+log = RingBuffer(args.windowRadius + 1)
 
-with open(args.logFileName, ('w' if args.clearLog else 'a'), buffering=1) as logFile:
-    print('', file=logFile)
-    writeToFile([_now(), 'Start run.'])
+with open(args.logFileName, ('wb' if args.clearLog else 'ab'), buffering=0) as logFile:
+    logFd = logFile.fileno()
+    writeToFile('')
+    writeToFile('Start run.', _formatTime(_now()))
 
     summary = "Searching for regexes: " + str(args.regex) + ", counting by " + args.mode
     if args.mode == EVENT_NOPULSE:
         summary += ' in ' + str(args.windowSecs) + ' sec'
     summary += ' with window radius ' + str(args.windowRadius)
 
-    writeToFile([_now(), summary])
+    writeToFile(summary, _formatTime(_now()))
     print(summary);
     print("Press Ctrl+C to see stats.\n----")
 
     start_time = _now()
-    last_match_time = _now()
+    last_match_time = time.monotonic()  # For --nopulse.
     saw_pulse = False  # on the current line.
 
 
     # Read loop
+    # Buffer all the output from each batch of input, and write it out in one go.
+    # Lines are echoed straight to the binary buffer, so any text output has to be flushed before it.
+    sys.stdout.reconfigure(line_buffering=False)
+    sys.stdout.flush()
     try:
         while True:
             try:
-                for port in range(len(serialPorts)):
-                    while processPort(port):
-                        pass
+                processReadyPorts()
+                sys.stdout.flush()
+                flushLog()
 
             except KeyboardInterrupt:
                 printStats()
-                print("Press Ctrl+C again to quit.")
+                print("Press Ctrl+C again to quit.", flush=True)
                 time.sleep(3)
     except KeyboardInterrupt:
         pass
-
-
-    # Cleanup.
-    writeToFile([_now(), 'Closing.'])
+    finally:
+        # Cleanup, however the loop ended, so that output that's been queued up isn't lost to an error
+        # (like a port going away).
+        for i in range(len(portBuffers)):
+            processLeftover(i)
+        writeToFile('Closing.', _formatTime(_now()))
+        sys.stdout.flush()
+        flushLog()